@@ -1,42 +1,130 @@
 from dash import dcc, html, Input, Output, State, ctx, no_update
+from dash.exceptions import PreventUpdate
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+import math
+import threading
+import time
 
 
+__all__ = ['DashProtected', 'NULL_TOKEN']
+
 NULL_TOKEN = 'null'
 
+# Dash dependencies shared by the callbacks DashProtected registers.  These 
+# never change, so they are built once and reused across registrations.
+_CURRENT_TOKEN_INPUT = Input('current_api_token', 'data')
+_CURRENT_TOKEN_STATE = State('current_api_token', 'data')
+_LAST_TOKEN_STATE    = State('last_api_token',    'data')
+_USER_INFO_STATE     = State('user_info',         'data')
+
+# Outputs and states of the login/logout callback
+_AUTH_OUTPUTS = (
+    Output('current_api_token', 'data'),
+    Output('last_api_token',    'data'),
+    Output('user_info',         'data')
+)
+_AUTH_STATES = (
+    _CURRENT_TOKEN_STATE,
+    State('username', 'value'),
+    State('password', 'value')
+)
+
+# Token dependencies added to every protected callback, spliced around the 
+# user's specifiers
+_CURRENT_TOKEN_OUTPUTS = (
+    Output('current_api_token', 'data', allow_duplicate=True),    # maps to a toplevel dcc.Store
+    Output('last_api_token',    'data', allow_duplicate=True)     # maps to a toplevel dcc.Store
+)
+_TRAILING_TOKEN_STATE = (
+    _CURRENT_TOKEN_STATE,
+)
+
+# Clientside gate in front of the login callback: passes the click count on to
+# the toplevel 'login_gate' dcc.Store only when both username and password are
+# filled in, so empty submissions never reach the server
+_LOGIN_GATE_JS = '''
+function(n_clicks, username, password) {
+    if (!username || !password) {
+        return window.dash_clientside.no_update;
+    }
+    return n_clicks;
+}
+'''
+
+# Key prefix for token status entries kept in an external cache backend
+_TOKEN_CACHE_PREFIX = 'DashProtected.token.'
+
+# Number of entries the in-process token cache may hold before it is pruned
+_TOKEN_CACHE_MAX = 1024
+
 
 class _CallbackState:
     ''' 
-    Manages wrapping and unwrapping of function arguments and outputs 
+    Holds the api tokens and unwrapped function arguments of one wrapped 
+    callback invocation 
     (For internal use)
     '''
 
-    def __init__(self, *data):
+    # No per-instance __dict__; one is created for every wrapped callback call
+    __slots__ = ('CurrentApiToken', 'LastApiToken', 'Inputs')
+
+    def __init__(self, data):
         ''' 
-        Initializes _CallbackState with input data coming from a Dash callback.
-        Saves the input data and sets the current API token, which should be 
-        the last argument.
+        Initializes _CallbackState with the argument tuple coming from a Dash 
+        callback.  Sets the current API token, which should be the last 
+        argument, and saves everything before it as the wrapped function input.
         '''
         self.CurrentApiToken = data[-1]
         self.LastApiToken = self.CurrentApiToken
-        self.Data = data
+        self.Inputs = data[0:-1]
         
     def unwrap_input(self):
         ''' 
-        Returns argument input expected by wrapped function.  This should be 
+        Returns argument input expected by wrapped function.  This is 
         everything EXCEPT the last argument which is the current api token.
         '''
-        return self.Data[0:-1]
-        
-    def wrap_output(self, *data):
+        return self.Inputs
+    
+
+class _WrappedCallback:
+    ''' 
+    Callable registered with Dash in place of a function decorated with 
+    DashProtected.callback.  Unwraps the api token, calls the function and 
+    wraps its output with the refreshed token.
+    (For internal use)
+    '''
+
+    __slots__ = ('Func', 'TokenGetter', 'SingleOutput', 
+                 '__name__', '__qualname__')
+
+    def __init__(self, protected, func, single_output, refresh_token):
         ''' 
-        Constructs wrapped output expected by Dash.  For callbacks that have been  
-        wrapped with DashProtect, the first two arguments should be the current 
-        and previous api tokens.
+        Initializes _WrappedCallback for func on the given DashProtected 
+        instance.  single_output tells whether func feeds one Dash output, and 
+        refresh_token whether the token status is asked of the auth api after 
+        each call, or the token only touched.
         '''
-        retval = [self.CurrentApiToken, self.LastApiToken]
-        retval.extend(*data)
-        return tuple(retval)
-    
+        self.Func = func
+        # Bound once, not per call
+        self.TokenGetter = protected._get_token_status if refresh_token else protected._touch_token
+        self.SingleOutput = single_output
+        self.__name__ = getattr(func, '__name__', 'callback')
+        self.__qualname__ = getattr(func, '__qualname__', self.__name__)
+
+    def __call__(self, *func_args):
+        ''' Runs the wrapped function with the Dash callback arguments '''
+        dpcs = _CallbackState(func_args)
+        output_data = self.Func(*dpcs.unwrap_input())
+
+        dpcs.CurrentApiToken = self.TokenGetter(dpcs.CurrentApiToken)
+
+        # Dash expects the current and previous api tokens ahead of the 
+        # wrapped function outputs, built here as one tuple
+        if self.SingleOutput:
+            return (dpcs.CurrentApiToken, dpcs.LastApiToken, output_data)
+        return (dpcs.CurrentApiToken, dpcs.LastApiToken, *output_data)
+
 
 class DashProtected:
     ''' 
@@ -44,7 +132,8 @@ class DashProtected:
     backend API 
     '''
 
-    def __init__(self, dash_app, auth_api, login_view_builder, content_view_builder):
+    def __init__(self, dash_app, auth_api, login_view_builder, content_view_builder,
+                 cache_backend=None, token_cache_ttl=60.0, legacy_single_button=False):
         ''' 
         Initializes a wrapper around Dash that provides auth capabilities using
         a backend API. 
@@ -62,6 +151,15 @@ class DashProtected:
                                      or None on invalid token
                          -invalidate_token(api_token):
                             Invalidates token and returns None
+                         -verify_signature(api_token)  (optional)
+                            Returns: True if the token is well formed and 
+                                     correctly signed, checked in-process 
+                                     without contacting the backend; tokens
+                                     failing this are rejected outright
+                         -touch(api_token)  (optional)
+                            Records token activity, eg- bumps a last seen 
+                            time.  Called in the background by protected 
+                            callbacks that do not refresh the token.
 
             login_view_builder, 
             content_view_builder: View builders for the login screen and the main 
@@ -76,6 +174,23 @@ class DashProtected:
                                   dummy elements with ids 'username' and 'password to 
                                   prevent callback errors; ie- a pair of dcc.Store with '
                                   dummy values can be used.
+
+            cache_backend: Optional shared cache used to hold token status results,
+                           eg- a Flask-Caching or Redis-backed cache object.  It
+                           must support get(key), set(key, value, timeout) and
+                           delete(key).  Use this when the app runs in several
+                           processes; otherwise an in-process dict is used.
+
+            token_cache_ttl: Number of seconds a token status result is reused
+                             before the auth api is asked again.  0 turns 
+                             caching off.  A cache_backend is given the ttl 
+                             rounded up to whole seconds.
+
+            legacy_single_button: If True, login and logout are both handled by a
+                                  single toggle button with id 'loginout'.  
+                                  Otherwise the layout must have separate 
+                                  buttons with ids 'login' and 'logout', and
+                                  a dcc.Store with id 'login_gate'.
                                      
         '''
         
@@ -83,49 +198,133 @@ class DashProtected:
         self.AuthApi = auth_api        
         self.LoginViewBuilder = login_view_builder
         self.ContentViewBuilder = content_view_builder                
+        self.CacheBackend = cache_backend
+        self._GetTokenStatus = auth_api.get_token_status   # Bound once, not per lookup
+        self._VerifySignature = getattr(auth_api, 'verify_signature', None)
+        self._Touch = getattr(auth_api, 'touch', None)
+
+        # Background worker for touch(), started on first use.  At most one 
+        # touch per token is pending: api_token -> Future
+        self._Executor = None
+        self._PendingTouches = {}
+        self._TouchLock = threading.Lock()
+
+        # Token status cache: api_token -> (status, time checked)
+        self._TokenCache = {}
+        self._TokenCacheTTL = token_cache_ttl
+
+        # Token status lookups in flight: api_token -> Future.  Concurrent 
+        # callbacks with the same token wait on one backend call.
+        self._InFlight = {}
+        self._InFlightLock = threading.Lock()
+
+        # Bumped by _forget_token(), so that a lookup which was in flight when
+        # a token was invalidated does not cache the status it got before
+        self._ForgetCount = 0
+
+        # Built layouts, keyed by view builder.  See invalidate_layouts()
+        self._LayoutCache = {}
                 
-        # Sets up a dash callback to toggele the view between 
-        # login and content based on token values
-        self.DashApp.callback(
-            Output ('main',              'children'), 
-            Output ('user_info_display', 'children'), 
-            Input  ('current_api_token', 'data'),
-            State  ('last_api_token',    'data'), 
-            State  ('user_info',         'data'), 
-            State  ('main',              'children')) (self._show_view) 
-
-        # Sets up a dash callback to handle login.  Prevent initial call is required
-        # to be true because of the allow duplicate
-        self.DashApp.callback(
-            Output ('current_api_token', 'data', allow_duplicate=True),
-            Output ('last_api_token',    'data', allow_duplicate=True),
-            Output ('user_info',         'data', allow_duplicate=True),
-            Input  ('login',             'n_clicks'),
-            State  ('current_api_token', 'data'),
-            State  ('username',          'value'),
-            State  ('password',          'value'), prevent_initial_call=True) (self._login)
-
-        # Sets up a dash callback to handle logout.  Prevent initial call is required
-        # to be true because of the allow duplicate
-        self.DashApp.callback(
-            Output ('current_api_token', 'data', allow_duplicate=True),
-            Output ('last_api_token',    'data', allow_duplicate=True),
-            Output ('user_info',         'data', allow_duplicate=True),
-            Input  ('logout',            'n_clicks'),
-            State  ('current_api_token', 'data'), prevent_initial_call=True) (self._logout)
+        # Dash callbacks set up by DashProtected, as (dependencies, handler, 
+        # prevent_initial_call) and registered together below.  None leaves 
+        # prevent_initial_call to the app's prevent_initial_callbacks setting.
+        callback_specs = [
+            # Toggles the view between login and content based on token values
+            ([Output ('main',              'children'), 
+              Output ('user_info_display', 'children'), 
+              _CURRENT_TOKEN_INPUT,
+              _LAST_TOKEN_STATE, 
+              _USER_INFO_STATE, 
+              State  ('main',              'children')], self._show_view, None)
+        ]
+
+        if legacy_single_button:
+            # Toggles between login and logout from a single button.  Prevent 
+            # initial call keeps the button from firing on page load.
+            callback_specs.append(
+                ([*_AUTH_OUTPUTS,
+                  Input  ('loginout',          'n_clicks'),
+                  *_AUTH_STATES], self._loginout, True))
+        else:
+            # Lets login clicks through to the server only when the form is 
+            # filled in
+            self.DashApp.clientside_callback(_LOGIN_GATE_JS,
+                Output ('login_gate',        'data'),
+                Input  ('login',             'n_clicks'),
+                State  ('username',          'value'),
+                State  ('password',          'value'), prevent_initial_call=True)
+
+            # Handles both login and logout in a single callback.  Being the only 
+            # writer of these outputs apart from protected callbacks, it does not
+            # need allow duplicate.  Prevent initial call keeps the buttons from 
+            # firing on page load.
+            callback_specs.append(
+                ([*_AUTH_OUTPUTS,
+                  Input  ('login_gate',        'data'),
+                  Input  ('logout',            'n_clicks'),
+                  *_AUTH_STATES], self._route_login_logout, True))
+
+        dash_callback = self.DashApp.callback
+        for dependencies, handler, prevent_initial_call in callback_specs:
+            dash_callback(dependencies, 
+                prevent_initial_call=prevent_initial_call) (handler)
 
         
     def _show_view(self, current_api_token, last_api_token, user_info, existing_layout):
         ''' 
         Returns either the login or the content view if the token changed; 
-        otherwise returns the existing view 
+        otherwise prevents the update so that the existing view is kept and no
+        response payload is sent back 
         '''
         if last_api_token == current_api_token:
-            return no_update, no_update
-        elif current_api_token == NULL_TOKEN:
-            return self.LoginViewBuilder.build_layout(), NULL_TOKEN
+            raise PreventUpdate
+        if current_api_token == NULL_TOKEN:
+            return self._build_layout(self.LoginViewBuilder), NULL_TOKEN
         else:
-            return self.ContentViewBuilder.build_layout(), user_info
+            return self._build_layout(self.ContentViewBuilder), user_info
+
+
+    def _build_layout(self, view_builder):
+        ''' 
+        Returns the layout of the view builder, building it only on first use 
+        (For internal use)
+        '''
+        layout = self._LayoutCache.get(view_builder)
+        if layout is None:
+            layout = self._LayoutCache[view_builder] = view_builder.build_layout()
+        return layout
+
+
+    def invalidate_layouts(self):
+        ''' 
+        Discards the cached login and content layouts so that they are rebuilt 
+        by their view builders on the next view change, eg- after a theme or 
+        language change.
+        '''
+        self._LayoutCache.clear()
+
+
+    def _route_login_logout(self, login_n, logout_n, current_api_token, username, password):
+        ''' 
+        Dispatches to login or logout depending on which button triggered the 
+        callback.  Logins arrive through the 'login_gate' store, which is only 
+        written once username and password are both filled in.
+        '''
+        if ctx.triggered_id == 'logout':
+            return self._logout(logout_n, current_api_token)
+        return self._login(login_n, current_api_token, username, password)
+
+
+    def _loginout(self, n, current_api_token, username, password):
+        ''' 
+        Logs in when there is no current api token, otherwise logs out 
+        (legacy_single_button mode)
+        '''
+        if n is None:  # Protect against spurious invocations not related to clicking the button
+            return no_update, no_update, no_update
+        if current_api_token == NULL_TOKEN:
+            return self._login(n, current_api_token, username, password)
+        return self._logout(n, current_api_token)
 
 
     def _login(self, n, current_api_token, username, password):
@@ -149,55 +348,228 @@ class DashProtected:
             return no_update, no_update, no_update
         last_api_token = current_api_token
         self.AuthApi.invalidate_token(current_api_token)
+        self._forget_token(current_api_token)
         return NULL_TOKEN, last_api_token, NULL_TOKEN
 
 
+    def _get_token_status(self, api_token):
+        ''' 
+        Returns the status of the api token.  Tokens failing the auth api's 
+        in-process signature check are rejected without a backend call; others
+        ask the auth api only when there is no cached result younger than the 
+        token cache ttl.  Invalid tokens are returned as NULL_TOKEN.
+        (For internal use)
+        '''
+        if self._VerifySignature is not None and not self._VerifySignature(api_token):
+            return NULL_TOKEN
+
+        status = self._cached_token_status(api_token)
+        if status is None:
+            status = self._fetch_token_status(api_token)
+        return status
+
+
+    def _cached_token_status(self, api_token):
+        ''' 
+        Returns the cached status of the api token, or None if there is no 
+        result younger than the token cache ttl
+        (For internal use)
+        '''
+        if self.CacheBackend is not None:
+            return self.CacheBackend.get(_TOKEN_CACHE_PREFIX + str(api_token))
+
+        entry = self._TokenCache.get(api_token)
+        if entry is not None:
+            if time.monotonic() - entry[1] < self._TokenCacheTTL:
+                return entry[0]
+            self._TokenCache.pop(api_token, None)
+        return None
+
+
+    def _cache_token_status(self, api_token, status):
+        ''' 
+        Caches the status of the api token for the token cache ttl, unless 
+        caching is turned off
+        (For internal use)
+        '''
+        if self._TokenCacheTTL <= 0:
+            return
+
+        if self.CacheBackend is not None:
+            # Cache backends take whole seconds, and treat 0 as never expiring
+            self.CacheBackend.set(_TOKEN_CACHE_PREFIX + str(api_token), status, 
+                                  timeout=int(math.ceil(self._TokenCacheTTL)))
+            return
+
+        if len(self._TokenCache) >= _TOKEN_CACHE_MAX:
+            self._prune_token_cache()
+        self._TokenCache[api_token] = (status, time.monotonic())
+
+
+    def _prune_token_cache(self):
+        ''' 
+        Drops expired entries from the in-process token cache, then the oldest
+        ones if it is still full, so that tokens from past sessions do not 
+        pile up
+        (For internal use)
+        '''
+        now = time.monotonic()
+        entries = list(self._TokenCache.items())
+        for api_token, (status, checked) in entries:
+            if now - checked >= self._TokenCacheTTL:
+                self._TokenCache.pop(api_token, None)
+
+        # Entries are inserted in the order they were checked, so the first 
+        # ones are the oldest
+        excess = len(self._TokenCache) - _TOKEN_CACHE_MAX // 2
+        if excess > 0:
+            for api_token in list(self._TokenCache)[:excess]:
+                self._TokenCache.pop(api_token, None)
+
+
+    def _fetch_token_status(self, api_token):
+        ''' 
+        Asks the auth api for the status of the api token and caches it.  Only
+        one request per token is made at a time; callers arriving while it is
+        in flight wait for and share its result without caching it again.  
+        Invalid tokens are returned as NULL_TOKEN.
+        (For internal use)
+        '''
+        with self._InFlightLock:
+            future = self._InFlight.get(api_token)
+            owner = future is None
+            if owner:
+                future = self._InFlight[api_token] = Future()
+                forget_count = self._ForgetCount
+        if not owner:
+            return future.result()
+
+        try:
+            # A request that finished between the caller's cache miss and 
+            # taking ownership has already cached the status
+            status = self._cached_token_status(api_token)
+            if status is None:
+                status = self._GetTokenStatus(api_token)
+                if status is None:
+                    status = NULL_TOKEN
+                # Cached before the in-flight entry goes away, so later callers
+                # find one or the other.  Not cached if a token was forgotten
+                # meanwhile, and dropped again if that happened while caching.
+                if self._ForgetCount == forget_count:
+                    self._cache_token_status(api_token, status)
+                    if self._ForgetCount != forget_count:
+                        self._drop_token_status(api_token)
+            future.set_result(status)
+            return status
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._InFlightLock:
+                del self._InFlight[api_token]
+
+
+    def _touch_token(self, api_token):
+        ''' 
+        Returns the api token after the auth api's in-process signature check,
+        or NULL_TOKEN if it fails.  Lets the auth api record activity on a 
+        valid token without waiting for it, if the auth api supports touch(); 
+        a token already waiting to be touched is not queued again.
+        (For internal use)
+        '''
+        if self._VerifySignature is not None and not self._VerifySignature(api_token):
+            return NULL_TOKEN
+        if self._Touch is None or api_token == NULL_TOKEN:
+            return api_token
+
+        with self._TouchLock:
+            if api_token in self._PendingTouches:
+                return api_token
+            if self._Executor is None:
+                self._Executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='DashProtected')
+            future = self._PendingTouches[api_token] = self._Executor.submit(self._Touch, api_token)
+        # Outside the lock, as an already finished future runs it right here
+        future.add_done_callback(partial(self._touch_done, api_token))
+        return api_token
+
+
+    def _touch_done(self, api_token, future):
+        ''' 
+        Clears the pending touch of the api token once it has run
+        (For internal use)
+        '''
+        with self._TouchLock:
+            if self._PendingTouches.get(api_token) is future:
+                del self._PendingTouches[api_token]
+
+
+    def shutdown(self, wait=True):
+        ''' 
+        Stops the background worker used for the auth api's touch(), if it was
+        started.  If wait is True, returns once pending touches have run.
+        '''
+        with self._TouchLock:
+            executor, self._Executor = self._Executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+    def _forget_token(self, api_token):
+        ''' 
+        Drops any cached status for the api token, eg- after it was invalidated,
+        and keeps lookups already in flight from caching it again
+        (For internal use)
+        '''
+        with self._InFlightLock:
+            self._ForgetCount += 1
+        self._drop_token_status(api_token)
+
+
+    def _drop_token_status(self, api_token):
+        ''' 
+        Drops any cached status for the api token 
+        (For internal use)
+        '''
+        if self.CacheBackend is not None:
+            self.CacheBackend.delete(_TOKEN_CACHE_PREFIX + str(api_token))
+        else:
+            self._TokenCache.pop(api_token, None)
+
+
     @staticmethod
     def _wrap(*specifiers):
         ''' 
         Adds input/output dependencies to wrapped Dash callback to handle api tokens 
         (For internal use)
         ''' 
-        retval = [ 
-            Output('current_api_token', 'data', allow_duplicate=True),    # maps to a toplevel dcc.Store
-            Output('last_api_token',    'data', allow_duplicate=True)     # maps to a toplevel dcc.Store
-        ]
-        retval.extend(specifiers)
-        retval.append(
-            State('current_api_token', 'data')
-        )
-        return retval
+        return [*_CURRENT_TOKEN_OUTPUTS, *specifiers, *_TRAILING_TOKEN_STATE]
 
     
-    def callback(self, *args):
+    def callback(self, *args, refresh_token=True):
         ''' 
         A decorator that handles API tokens.  Use this descorator when the 
         wrapped callback should check tokens for validity, expiry, etc. An 
         expired or revoked token will trigger a state change and cause the 
         login view to be displayed.
 
+        Set refresh_token to False for callbacks that only touch the UI.  They
+        still receive the api token plumbing and the auth api's in-process 
+        signature check, but skip the token status check, and only notify the 
+        auth api's touch() in the background if it has one.
+
         If the callback does NOT require API token checking, use the usual
         Dash callback instead.        
         '''
-        def wrap_func(func):
-        
-            def apply_func(*func_args):
-                dpcs = _CallbackState(*func_args)
-                unwrapped_args = dpcs.unwrap_input()
+        dependencies = DashProtected._wrap(*args)
 
-                output_data = func(*unwrapped_args)
-                if not isinstance(output_data, tuple) or len(output_data) == 1:
-                    output_data = [ output_data ]                
-                
-                dpcs.CurrentApiToken = self.AuthApi.get_token_status(dpcs.CurrentApiToken)
-                if dpcs.CurrentApiToken is None:
-                    dpcs.CurrentApiToken = NULL_TOKEN
+        # The number of outputs fixes the shape of the return value: a single 
+        # output is always one value, even if it is a list or tuple, while 
+        # several outputs are always returned as a sequence of values
+        single_output = sum(1 for arg in args if isinstance(arg, Output)) == 1
 
-                retval = dpcs.wrap_output(output_data)
-                return retval
-        
-            return self.DashApp.callback(DashProtected._wrap(*args), 
-                prevent_initial_call=True) (apply_func)
+        def wrap_func(func):
+            return self.DashApp.callback(dependencies, 
+                prevent_initial_call=True) (_WrappedCallback(self, func, single_output, refresh_token))
 
         return wrap_func
     
@@ -1,8 +1,13 @@
 from dash import Dash, dcc, html, Input, Output, State
 from DashProtected import DashProtected, NULL_TOKEN
+import re
 import uuid
 
 
+# Matches the string form of a uuid, as handed out by DummyAuthApi
+_TOKEN_FORMAT = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
 class DummyAuthApi:
     ''' 
     Example AuthApi for DashProtected. This has a hardcoded set of valid 
@@ -28,6 +33,15 @@ class DummyAuthApi:
             return None
 
             
+    def verify_signature(self, api_token):
+        ''' 
+        Returns True if the token looks like one handed out by get_new_token.
+        A production implementation would check an HMAC or similar signature
+        here, eg- with hmac.compare_digest.
+        '''
+        return isinstance(api_token, str) and _TOKEN_FORMAT.fullmatch(api_token) is not None
+
+
     def get_token_status(self, api_token):
         ''' Returns the given api token is usages are under 5, or returns None '''
         self.Count = self.Count + 1
@@ -94,8 +108,11 @@ app.layout = html.Div([
 auth_api = DummyAuthApi()
 
 # Create a protected wrapper around the dash application that adds login
-# and logout capabilities
-dash_protected = DashProtected(app, auth_api, login_view_builder, content_view_builder)
+# and logout capabilities.  The layout above has a single 'loginout' button.
+# Token status caching is turned off so that DummyAuthApi's expiry after five 
+# usages shows up right away.
+dash_protected = DashProtected(app, auth_api, login_view_builder, content_view_builder,
+                               token_cache_ttl=0, legacy_single_button=True)
 
 # If per-call token checking is a desired feature, then decorate the handler 
 # with the @dash_protected version of the callback.  If this is not a desired 
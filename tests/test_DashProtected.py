@@ -0,0 +1,176 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+from dash import Dash
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DashProtected as dash_protected_module
+from DashProtected import DashProtected, NULL_TOKEN
+
+
+class BlockingAuthApi:
+    '''
+    Auth api whose get_token_status and touch block until released, so that
+    tests can line up concurrent callers
+    '''
+    def __init__(self, error=None):
+        self.Error = error
+        self.StatusCalls = 0
+        self.TouchCalls = 0
+        self.Started = threading.Event()
+        self.Release = threading.Event()
+
+    def get_token_status(self, api_token):
+        self.StatusCalls += 1
+        self.Started.set()
+        self.Release.wait(5)
+        if self.Error is not None:
+            raise self.Error
+        return api_token
+
+    def touch(self, api_token):
+        self.TouchCalls += 1
+        self.Release.wait(5)
+
+    def invalidate_token(self, api_token):
+        pass
+
+
+def make_protected(auth_api, **kwargs):
+    ''' Returns a DashProtected around a fresh Dash app '''
+    return DashProtected(Dash(__name__), auth_api, None, None, **kwargs)
+
+
+def run_concurrently(func, n, api_token):
+    '''
+    Calls func(api_token) from n threads, the first of which gets into the
+    auth api before the others start.  Returns the results or exceptions.
+    '''
+    results = [None] * n
+
+    def call(i):
+        try:
+            results[i] = func(api_token)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+    threads[0].start()
+    return threads, results
+
+
+class TokenStatusTest(unittest.TestCase):
+
+    def _run(self, auth_api, protected, n=20):
+        threads, results = run_concurrently(protected._get_token_status, n, 'token')
+        self.assertTrue(auth_api.Started.wait(5))
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.2)   # Let the other callers reach the in-flight future
+        auth_api.Release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_concurrent_callers_share_one_lookup(self):
+        auth_api = BlockingAuthApi()
+        protected = make_protected(auth_api)
+        results = self._run(auth_api, protected)
+        self.assertEqual(auth_api.StatusCalls, 1)
+        self.assertEqual(results, ['token'] * 20)
+        self.assertEqual(protected._InFlight, {})
+
+        # Later callers are served from the cache
+        self.assertEqual(protected._get_token_status('token'), 'token')
+        self.assertEqual(auth_api.StatusCalls, 1)
+
+    def test_waiting_callers_see_owner_exception(self):
+        error = RuntimeError('backend down')
+        auth_api = BlockingAuthApi(error=error)
+        protected = make_protected(auth_api)
+        results = self._run(auth_api, protected, n=5)
+        self.assertEqual(auth_api.StatusCalls, 1)
+        self.assertTrue(all(result is error for result in results))
+        self.assertEqual(protected._InFlight, {})
+        self.assertEqual(protected._TokenCache, {})
+
+    def test_logout_during_lookup_is_not_cached(self):
+        auth_api = BlockingAuthApi()
+        protected = make_protected(auth_api)
+        thread = threading.Thread(target=protected._get_token_status, args=('token',))
+        thread.start()
+        self.assertTrue(auth_api.Started.wait(5))
+        protected._logout(1, 'token')
+        auth_api.Release.set()
+        thread.join(5)
+        self.assertNotIn('token', protected._TokenCache)
+
+    def test_zero_ttl_does_not_cache(self):
+        auth_api = BlockingAuthApi()
+        auth_api.Release.set()
+        backend = mock.Mock()
+        backend.get.return_value = None
+        for protected in (make_protected(auth_api, token_cache_ttl=0),
+                          make_protected(auth_api, token_cache_ttl=0, cache_backend=backend)):
+            protected._get_token_status('token')
+            self.assertEqual(protected._TokenCache, {})
+        backend.set.assert_not_called()
+
+    def test_cache_backend_gets_whole_seconds(self):
+        auth_api = BlockingAuthApi()
+        auth_api.Release.set()
+        backend = mock.Mock()
+        backend.get.return_value = None
+        protected = make_protected(auth_api, token_cache_ttl=2.5, cache_backend=backend)
+        protected._get_token_status('token')
+        self.assertEqual(backend.set.call_args.kwargs['timeout'], 3)
+        self.assertIsInstance(backend.set.call_args.kwargs['timeout'], int)
+
+
+class TokenCachePruneTest(unittest.TestCase):
+
+    def test_prune_drops_expired_then_oldest(self):
+        protected = make_protected(BlockingAuthApi(), token_cache_ttl=10)
+        now = time.monotonic()
+        protected._TokenCache.update({
+            'expired1': ('expired1', now - 20),
+            'oldest':   ('oldest',   now - 3),
+            'expired2': ('expired2', now - 11),
+            'older':    ('older',    now - 2),
+            'newer':    ('newer',    now - 1),
+            'newest':   ('newest',   now),
+        })
+        with mock.patch.object(dash_protected_module, '_TOKEN_CACHE_MAX', 4):
+            protected._prune_token_cache()
+        self.assertEqual(list(protected._TokenCache), ['newer', 'newest'])
+
+
+class TouchTest(unittest.TestCase):
+
+    def test_touch_is_not_queued_twice(self):
+        auth_api = BlockingAuthApi()
+        protected = make_protected(auth_api)
+        self.assertIsNone(protected._Executor)
+        for _ in range(5):
+            self.assertEqual(protected._touch_token('token'), 'token')
+        self.assertEqual(len(protected._PendingTouches), 1)
+
+        auth_api.Release.set()
+        protected.shutdown()
+        self.assertEqual(auth_api.TouchCalls, 1)
+        self.assertEqual(protected._PendingTouches, {})
+
+    def test_touch_rejects_bad_signature(self):
+        auth_api = BlockingAuthApi()
+        auth_api.verify_signature = lambda api_token: api_token != 'forged'
+        protected = make_protected(auth_api)
+        self.assertIs(protected._touch_token('forged'), NULL_TOKEN)
+        self.assertIsNone(protected._Executor)
+
+
+if __name__ == '__main__':
+    unittest.main()